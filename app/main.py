@@ -1,18 +1,36 @@
+import hashlib
+import orjson
+from contextlib import asynccontextmanager
 from fastapi import FastAPI, HTTPException, Request, Response
 from fastapi.middleware.cors import CORSMiddleware
-from fastapi.responses import JSONResponse
-from sqlalchemy.orm import Session
+from fastapi.middleware.gzip import GZipMiddleware
+from fastapi.responses import ORJSONResponse
 from app.db import engine
 from app.models.base import Base
 from app.routes import patients_router, observations_router
+from app.utils.cache import etag_matches
+from app.utils.response import FHIR_JSON, fhir_response
+from app.views import create_views, wait_for_refreshes
+
+
+@asynccontextmanager
+async def lifespan(app: FastAPI):
+    # Only create tables if they don't exist
+    async with engine.begin() as conn:
+        await conn.run_sync(Base.metadata.create_all)
+        await conn.run_sync(create_views)
+    yield
+    # Let searches catch up with the last writes before closing the pool
+    await wait_for_refreshes()
+    await engine.dispose()
 
-# Only create tables if they don't exist
-Base.metadata.create_all(bind=engine)
 
 app = FastAPI(
     title="FHIR-lite Server",
     description="A lightweight FHIR server implementation focusing on Patient and Observation resources",
     version="1.0.0",
+    default_response_class=ORJSONResponse,
+    lifespan=lifespan,
 )
 
 # CORS middleware
@@ -24,21 +42,15 @@ app.add_middleware(
     allow_headers=["*"],
 )
 
-
-# FHIR Content-Type middleware
-@app.middleware("http")
-async def add_fhir_content_type(request: Request, call_next):
-    response = await call_next(request)
-    if isinstance(response, JSONResponse):
-        response.headers["Content-Type"] = "application/fhir+json"
-    return response
+# Compress larger responses such as search Bundles, for clients that accept gzip
+app.add_middleware(GZipMiddleware, minimum_size=1024, compresslevel=5)
 
 
 # Error handling
 @app.exception_handler(HTTPException)
 async def http_exception_handler(request: Request, exc: HTTPException):
     """Convert HTTP exceptions to FHIR OperationOutcome format"""
-    return JSONResponse(
+    return fhir_response(
         status_code=exc.status_code,
         content={
             "resourceType": "OperationOutcome",
@@ -54,20 +66,19 @@ async def http_exception_handler(request: Request, exc: HTTPException):
 
 
 @app.get("/", include_in_schema=False)
-def read_root():
+async def read_root():
     """Redirect to API documentation"""
     return Response(status_code=302, headers={"Location": "/docs"})
 
 
 @app.head("/", include_in_schema=False)
-def health_check():
+async def health_check():
     return {"status": "ok"}
 
 
-@app.get("/metadata")
-def capability_statement():
-    """Return FHIR CapabilityStatement"""
-    return {
+# The CapabilityStatement never changes at runtime, so serialize it once
+CAPABILITY_STATEMENT_JSON = orjson.dumps(
+    {
         "resourceType": "CapabilityStatement",
         "status": "active",
         "date": "2023-11-21",
@@ -114,6 +125,21 @@ def capability_statement():
             }
         ],
     }
+)
+
+
+CAPABILITY_STATEMENT_ETAG = f'W/"{hashlib.sha1(CAPABILITY_STATEMENT_JSON).hexdigest()}"'
+
+
+@app.get("/metadata")
+async def capability_statement(request: Request):
+    """Return FHIR CapabilityStatement"""
+    headers = {"ETag": CAPABILITY_STATEMENT_ETAG}
+    if etag_matches(request, CAPABILITY_STATEMENT_ETAG):
+        return Response(status_code=304, headers=headers)
+    return Response(
+        content=CAPABILITY_STATEMENT_JSON, media_type=FHIR_JSON, headers=headers
+    )
 
 
 # Include FHIR routers
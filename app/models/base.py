@@ -1,23 +1,53 @@
-from sqlalchemy import Column, DateTime, String
-from sqlalchemy.ext.declarative import declarative_base
+from sqlalchemy import Column, DateTime, String, text
+from sqlalchemy.dialects.postgresql import UUID
+from sqlalchemy.orm import DeclarativeBase
 from sqlalchemy.sql import func
 from datetime import datetime
-import uuid
 
-Base = declarative_base()
+
+class Base(DeclarativeBase):
+    pass
+
+
+def json_object(fields):
+    """Build a JSON object in SQL from a dict of key -> column/expression.
+
+    Nested dicts become nested objects and null members are dropped, matching
+    the way to_fhir() omits empty elements.
+    """
+    args = []
+    for key, value in fields.items():
+        if isinstance(value, dict):
+            value = func.json_build_object(*[a for kv in value.items() for a in kv])
+        args.extend((key, value))
+    return func.json_strip_nulls(func.json_build_object(*args))
+
 
 class FHIRBaseModel(Base):
     __abstract__ = True
+    # Fetch server-generated values with RETURNING as part of the INSERT/UPDATE,
+    # so objects are complete after a flush without a follow-up SELECT
+    __mapper_args__ = {"eager_defaults": True}
     
-    id = Column(String, primary_key=True, default=lambda: str(uuid.uuid4()))
+    # Generated by Postgres on insert (gen_random_uuid() is built in since 13)
+    id = Column(
+        UUID(as_uuid=True), primary_key=True, server_default=text("gen_random_uuid()")
+    )
     resourceType = Column(String, nullable=False)
     created = Column(DateTime, default=datetime.utcnow)
     updated = Column(DateTime, default=datetime.utcnow, onupdate=datetime.utcnow)
+    # Idempotency-Key of the create request, so replays don't insert twice
+    idempotency_key = Column(String(255), unique=True)
 
     def to_fhir(self):
         """Convert to FHIR resource format"""
         raise NotImplementedError("Subclasses must implement to_fhir()")
 
+    @classmethod
+    def fhir_json(cls):
+        """SQL expression building the FHIR resource as JSON, mirroring to_fhir()"""
+        raise NotImplementedError("Subclasses must implement fhir_json()")
+
     def from_fhir(self, fhir_dict):
         """Update from FHIR resource format"""
         raise NotImplementedError("Subclasses must implement from_fhir()")
@@ -1,7 +1,10 @@
-from sqlalchemy import Column, String, Float, DateTime, ForeignKey, Enum, JSON
+from sqlalchemy import Column, String, Float, DateTime, ForeignKey, Enum, Index, cast, func
+from sqlalchemy.dialects.postgresql import JSONB, UUID
 from sqlalchemy.orm import relationship
-from .base import FHIRBaseModel
+from .base import FHIRBaseModel, json_object
 import enum
+import uuid
+from datetime import datetime, timezone
 
 class ObservationStatus(str, enum.Enum):
     registered = "registered"
@@ -13,28 +16,38 @@ class ObservationStatus(str, enum.Enum):
 
 class Observation(FHIRBaseModel):
     __tablename__ = "observations"
+    __table_args__ = (
+        # Searches go through observation_fhir_mv, which has its own indexes.
+        # This one serves the ON DELETE CASCADE lookup when a patient goes.
+        Index("ix_obs_subject_reference", "subject_reference"),
+    )
 
     # Status
     status = Column(Enum(ObservationStatus), nullable=False)
     
     # Category and Code (stored as FHIR CodeableConcept)
-    category = Column(JSON)  # [{coding: [{system, code, display}], text}]
-    code = Column(JSON, nullable=False)  # {coding: [{system, code, display}], text}
+    category = Column(JSONB)  # [{coding: [{system, code, display}], text}]
+    code = Column(JSONB, nullable=False)  # {coding: [{system, code, display}], text}
     
     # Subject reference (Patient)
-    subject_reference = Column(String, ForeignKey("patients.id"), nullable=False)
+    subject_reference = Column(
+        UUID(as_uuid=True),
+        ForeignKey("patients.id", ondelete="CASCADE"),
+        nullable=False,
+    )
     
     # Timing
     effective_datetime = Column(DateTime)
     
     # Value[x] - focusing on Quantity for now
-    value_quantity = Column(JSON)  # {value: float, unit: string, system: uri, code: string}
+    value_quantity = Column(JSONB)  # {value: float, unit: string, system: uri, code: string}
     
     # Reference Ranges
-    reference_range = Column(JSON)  # [{low: {value, unit}, high: {value, unit}}]
+    reference_range = Column(JSONB)  # [{low: {value, unit}, high: {value, unit}}]
     
     # Relationships
-    patient = relationship("Patient", back_populates="observations")
+    # Lazy loads raise, use joinedload(Observation.patient) when it's needed
+    patient = relationship("Patient", back_populates="observations", lazy="raise")
 
     def to_fhir(self):
         """Convert to FHIR resource format"""
@@ -44,21 +57,33 @@ class Observation(FHIRBaseModel):
             "status": self.status,
             "category": self.category,
             "code": self.code,
-            "subject": {
-                "reference": f"Patient/{self.subject_reference}"
-            }
+            "subject": {"reference": "Patient/" + str(self.subject_reference)},
+            "effectiveDateTime": (
+                self.effective_datetime and self.effective_datetime.isoformat()
+            ),
+            "valueQuantity": self.value_quantity,
+            "referenceRange": self.reference_range,
         }
-        
-        if self.effective_datetime:
-            resource["effectiveDateTime"] = self.effective_datetime.isoformat()
-            
-        if self.value_quantity:
-            resource["valueQuantity"] = self.value_quantity
-            
-        if self.reference_range:
-            resource["referenceRange"] = self.reference_range
-            
-        return resource
+        # Empty elements are left out, as in fhir_json()
+        return {key: value for key, value in resource.items() if value is not None}
+
+    @classmethod
+    def fhir_json(cls):
+        """SQL expression building the FHIR resource as JSON, mirroring to_fhir()"""
+        return json_object({
+            "resourceType": "Observation",
+            "id": cls.id,
+            # The enum column stores member names, FHIR codes use hyphens
+            "status": func.replace(cast(cls.status, String), "_", "-"),
+            "category": cls.category,
+            "code": cls.code,
+            "subject": {
+                "reference": func.concat("Patient/", cls.subject_reference)
+            },
+            "effectiveDateTime": cls.effective_datetime,
+            "valueQuantity": cls.value_quantity,
+            "referenceRange": cls.reference_range,
+        })
 
     def from_fhir(self, fhir_dict):
         """Update from FHIR resource format"""
@@ -72,11 +97,20 @@ class Observation(FHIRBaseModel):
         # Extract patient ID from reference
         subject_ref = fhir_dict.get("subject", {}).get("reference", "")
         if subject_ref.startswith("Patient/"):
-            self.subject_reference = subject_ref.split("Patient/")[1]
+            try:
+                self.subject_reference = uuid.UUID(subject_ref.split("Patient/")[1])
+            except ValueError:
+                raise ValueError(f"Invalid subject reference: {subject_ref}")
         
         # Handle effective[x]
         if "effectiveDateTime" in fhir_dict:
-            self.effective_datetime = fhir_dict["effectiveDateTime"]
+            effective = fhir_dict["effectiveDateTime"]
+            if effective:
+                effective = datetime.fromisoformat(effective)
+                # Stored as naive UTC
+                if effective.tzinfo:
+                    effective = effective.astimezone(timezone.utc).replace(tzinfo=None)
+            self.effective_datetime = effective
             
         # Handle value[x]
         if "valueQuantity" in fhir_dict:
@@ -1,9 +1,10 @@
-from sqlalchemy import Column, String, Date, Enum, JSON
+from sqlalchemy import Boolean, Column, Date, Enum
+from sqlalchemy.dialects.postgresql import JSONB
 from sqlalchemy.orm import relationship
-from .base import FHIRBaseModel
+from .base import FHIRBaseModel, json_object
 import enum
+from datetime import date
 from typing import List, Optional
-import json
 
 
 class Gender(str, enum.Enum):
@@ -35,22 +36,29 @@ class Patient(FHIRBaseModel):
     __tablename__ = "patients"
 
     # Basic attributes
-    active = Column(String(5), default="true")  # FHIR boolean as string
+    active = Column(Boolean, default=True)
     gender = Column(Enum(Gender))
     birth_date = Column(Date)
 
     # Name components stored as JSON
-    name = Column(JSON)  # [{use, family, given[], prefix[], suffix[]}]
+    name = Column(JSONB)  # [{use, family, given[], prefix[], suffix[]}]
 
     # Contact information
-    telecom = Column(JSON)  # [{system, value, use}]
+    telecom = Column(JSONB)  # [{system, value, use}]
     address = Column(
-        JSON
+        JSONB
     )  # [{use, type, text, line[], city, state, postalCode, country}]
 
     # Relationships
+    # Deleting a patient leaves its observations to ON DELETE CASCADE in the
+    # database instead of loading and deleting them one by one. Lazy loads
+    # raise, so load them explicitly with selectinload(Patient.observations).
     observations = relationship(
-        "Observation", back_populates="patient", cascade="all, delete-orphan"
+        "Observation",
+        back_populates="patient",
+        cascade="all, delete-orphan",
+        passive_deletes=True,
+        lazy="raise",
     )
 
     def add_email(self, email: str, use: Optional[str] = None):
@@ -85,25 +93,31 @@ class Patient(FHIRBaseModel):
         resource = {
             "resourceType": "Patient",
             "id": self.id,
-            "active": self.active == "true",
+            "active": self.active,
+            "name": self.name or None,
+            "gender": self.gender,
+            "birthDate": self.birth_date and self.birth_date.isoformat(),
+            "telecom": self.telecom or None,
+            "address": self.address or None,
         }
-
-        if self.name:
-            resource["name"] = self.name
-
-        if self.gender:
-            resource["gender"] = self.gender
-
-        if self.birth_date:
-            resource["birthDate"] = self.birth_date.isoformat()
-
-        if self.telecom:
-            resource["telecom"] = self.telecom
-
-        if self.address:
-            resource["address"] = self.address
-
-        return resource
+        # Empty elements are left out, as in fhir_json()
+        return {key: value for key, value in resource.items() if value is not None}
+
+    @classmethod
+    def fhir_json(cls):
+        """SQL expression building the FHIR resource as JSON, mirroring to_fhir()"""
+        return json_object(
+            {
+                "resourceType": "Patient",
+                "id": cls.id,
+                "active": cls.active,
+                "name": cls.name,
+                "gender": cls.gender,
+                "birthDate": cls.birth_date,
+                "telecom": cls.telecom,
+                "address": cls.address,
+            }
+        )
 
     def from_fhir(self, fhir_dict):
         """Update from FHIR resource format"""
@@ -125,20 +139,24 @@ class Patient(FHIRBaseModel):
                 for t in fhir_dict.get("telecom", [])
                 if t.get("system") and t.get("value")
             ]
-        self.telecom = telecom or None
+            self.telecom = telecom or None
 
         # Handle other attributes
         if "active" in fhir_dict:
-            self.active = str(fhir_dict.get("active", True)).lower()
+            active = fhir_dict["active"]
+            if not isinstance(active, bool):
+                raise ValueError("active must be a boolean")
+            self.active = active
 
         if "gender" in fhir_dict:
             self.gender = fhir_dict.get("gender")
 
         if "birthDate" in fhir_dict:
-            self.birth_date = fhir_dict.get("birthDate")
+            birth_date = fhir_dict.get("birthDate")
+            self.birth_date = birth_date and date.fromisoformat(birth_date)
 
         if "address" in fhir_dict:
             raw_address = fhir_dict["address"]
-            self.address = None if raw_address in [None, "null"] else raw_address
+            self.address = None if raw_address == "null" else raw_address or None
 
         return self
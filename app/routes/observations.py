@@ -1,112 +1,143 @@
-from fastapi import APIRouter, Depends, HTTPException, Response, Query
-from sqlalchemy.orm import Session
+from fastapi import (
+    APIRouter,
+    Depends,
+    Header,
+    HTTPException,
+    Query,
+    Request,
+    Response,
+)
+from fastapi.responses import ORJSONResponse
+from sqlalchemy import func, select
+from sqlalchemy.ext.asyncio import AsyncSession
 from typing import List, Optional
 from app.db import get_db
 from app.models.observation import Observation
-from app.utils.db import safe_db_operation, safe_add, safe_commit, safe_refresh
-from datetime import datetime
-
-router = APIRouter()
+from app.utils.db import (
+    safe_commit,
+    safe_delete,
+    safe_execute,
+    safe_refresh,
+    save_and_refresh,
+)
+from app.utils.cache import cached_read
+from app.utils.response import fhir_response
+from app.views import observation_fhir_mv, schedule_refresh
+from datetime import datetime, timezone
+import uuid
+
+router = APIRouter(default_response_class=ORJSONResponse)
 
 
 @router.post("/", status_code=201)
-def create_observation(
-    fhir_resource: dict, response: Response, db: Session = Depends(get_db)
+async def create_observation(
+    fhir_resource: dict,
+    idempotency_key: Optional[str] = Header(None),
+    db: AsyncSession = Depends(get_db),
 ):
     """Create a new observation from FHIR resource"""
     try:
         observation = Observation()
         observation.from_fhir(fhir_resource)
-        print("→ About to add observation")
-        safe_add(db, observation)
-        print("✓ Observation added")
-
-        print("→ About to commit")
-        safe_commit(db)
-        print("✓ Commit done")
-
-        print("→ About to refresh")
-        safe_refresh(db, observation)
-        print("✓ Refresh done")
+        observation = await save_and_refresh(db, observation, idempotency_key)
 
-        # Set Location header
-        response.headers["Location"] = f"/Observation/{observation.id}"
-        return observation.to_fhir()
+        schedule_refresh(observation_fhir_mv)
+        return fhir_response(
+            observation.to_fhir(),
+            status_code=201,
+            headers={"Location": f"/Observation/{observation.id}"},
+        )
     except ValueError as e:
         raise HTTPException(status_code=400, detail=str(e))
     except Exception as e:
         raise HTTPException(status_code=500, detail=str(e))
 
 
-@router.get("/", response_model=dict)
-def search_observations(
+@router.get("/")
+async def search_observations(
     patient: Optional[str] = Query(None),
     category: Optional[str] = Query(None),
     code: Optional[str] = Query(None),
-    date: Optional[str] = Query(None),
+    date: Optional[datetime] = Query(None),
     _count: Optional[int] = Query(10, alias="count"),
     _offset: Optional[int] = Query(0),
-    db: Session = Depends(get_db),
+    db: AsyncSession = Depends(get_db),
 ):
     """Search for observations with FHIR search parameters"""
-    query = db.query(Observation)
+    view = observation_fhir_mv.c
+    # Entries are pre-built in the view, COUNT(*) OVER () adds the match total
+    # to the same round trip
+    query = select(view.entry, func.count().over())
 
     if patient:
         if patient.startswith("Patient/"):
             patient = patient.split("Patient/")[1]
-        query = query.filter(Observation.subject_reference == patient)
+        try:
+            patient = uuid.UUID(patient)
+        except ValueError:
+            raise HTTPException(status_code=400, detail="Invalid patient reference")
+        query = query.where(view.subject_reference == patient)
 
     if category:
-        query = query.filter(
-            Observation.category.contains([{"coding": [{"code": category}]}])
-        )
+        query = query.where(view.category.contains([{"coding": [{"code": category}]}]))
 
     if code:
-        query = query.filter(Observation.code.contains({"coding": [{"code": code}]}))
+        query = query.where(view.code.contains({"coding": [{"code": code}]}))
 
     if date:
         # Handle date equality for now (could be expanded to support ranges)
-        query = query.filter(
-            Observation.effective_datetime == datetime.fromisoformat(date)
-        )
-
-    total = query.count()
-    observations = query.offset(_offset).limit(_count).all()
-
-    return {
+        # Stored as naive UTC
+        if date.tzinfo:
+            date = date.astimezone(timezone.utc).replace(tzinfo=None)
+        query = query.where(view.effective_datetime == date)
+
+    rows = (await safe_execute(db, query.offset(_offset).limit(_count))).all()
+    if rows:
+        total = rows[0][1]
+    elif _offset:
+        # An empty page past the end still needs the real total
+        count_query = select(func.count()).select_from(query.subquery())
+        total = (await safe_execute(db, count_query)).scalar()
+    else:
+        total = 0
+
+    bundle = {
         "resourceType": "Bundle",
         "type": "searchset",
         "total": total,
-        "entry": [
-            {"resource": obs.to_fhir(), "fullUrl": f"/Observation/{obs.id}"}
-            for obs in observations
-        ],
+        "entry": [entry for entry, _ in rows],
     }
+    return fhir_response(bundle)
 
 
 @router.get("/{observation_id}")
-def get_observation(observation_id: str, db: Session = Depends(get_db)):
+async def get_observation(
+    observation_id: uuid.UUID, request: Request, db: AsyncSession = Depends(get_db)
+):
     """Get a specific observation by ID"""
-    observation = db.query(Observation).filter(Observation.id == observation_id).first()
-    if observation is None:
+    response = await cached_read(request, db, Observation, observation_id)
+    if response is None:
         raise HTTPException(status_code=404, detail="Observation not found")
-    return observation.to_fhir()
+    return response
 
 
 @router.put("/{observation_id}")
-def update_observation(
-    observation_id: str, fhir_resource: dict, db: Session = Depends(get_db)
+async def update_observation(
+    observation_id: uuid.UUID,
+    fhir_resource: dict,
+    db: AsyncSession = Depends(get_db),
 ):
     """Update an observation from FHIR resource"""
-    observation = db.query(Observation).filter(Observation.id == observation_id).first()
+    observation = await db.get(Observation, observation_id)
     if observation is None:
         raise HTTPException(status_code=404, detail="Observation not found")
 
     try:
         observation.from_fhir(fhir_resource)
-        safe_db_operation(db, operation="commit")
-        safe_db_operation(db, observation, "refresh")
-        return observation.to_fhir()
+        await safe_commit(db)
+        await safe_refresh(db, observation)
+        schedule_refresh(observation_fhir_mv)
+        return fhir_response(observation.to_fhir())
     except ValueError as e:
         raise HTTPException(status_code=400, detail=str(e))
     except Exception as e:
@@ -114,13 +145,17 @@ def update_observation(
 
 
 @router.delete("/{observation_id}", status_code=204)
-def delete_observation(observation_id: str, db: Session = Depends(get_db)):
+async def delete_observation(
+    observation_id: uuid.UUID,
+    db: AsyncSession = Depends(get_db),
+):
     """Delete an observation"""
-    observation = db.query(Observation).filter(Observation.id == observation_id).first()
+    observation = await db.get(Observation, observation_id)
     if observation is None:
         # Return 204 even if not found, as per FHIR spec
         return Response(status_code=204)
 
-    safe_db_operation(db, observation, "delete")
-    safe_db_operation(db, operation="commit")
+    await safe_delete(db, observation)
+    await safe_commit(db)
+    schedule_refresh(observation_fhir_mv)
     return Response(status_code=204)
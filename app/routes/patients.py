@@ -1,44 +1,39 @@
-from fastapi import APIRouter, Depends, HTTPException, Response, Query
-from sqlalchemy.orm import Session
+from fastapi import (
+    APIRouter,
+    Depends,
+    Header,
+    HTTPException,
+    Query,
+    Request,
+    Response,
+)
+from fastapi.responses import ORJSONResponse
+from sqlalchemy import func, select
+from sqlalchemy.ext.asyncio import AsyncSession
 from typing import List, Optional
 from app.db import get_db
 from app.models.patient import Patient, ContactSystem, ContactUse
 from app.utils.db import (
-    safe_db_operation,
-    safe_add,
     safe_commit,
+    safe_delete,
+    safe_execute,
     safe_refresh,
+    save_and_refresh,
 )
-from pydantic import BaseModel, EmailStr, constr
+from app.utils.cache import cached_read
+from app.utils.response import fhir_response
+from app.views import observation_fhir_mv, patient_fhir_mv, schedule_refresh
+from pydantic import BaseModel
 from datetime import date
-from enum import Enum
 import uuid
 
-router = APIRouter()
-
-
-class TelecomSystem(str, Enum):
-    phone = "phone"
-    email = "email"
-    fax = "fax"
-    pager = "pager"
-    url = "url"
-    sms = "sms"
-    other = "other"
-
-
-class TelecomUse(str, Enum):
-    home = "home"
-    work = "work"
-    temp = "temp"
-    old = "old"
-    mobile = "mobile"
+router = APIRouter(default_response_class=ORJSONResponse)
 
 
 class Telecom(BaseModel):
-    system: TelecomSystem
+    system: ContactSystem
     value: str
-    use: Optional[TelecomUse] = None
+    use: Optional[ContactUse] = None
 
 
 class PatientBase(BaseModel):
@@ -66,8 +61,10 @@ class PatientResponse(PatientBase):
 
 
 @router.post("/", status_code=201)
-def create_patient(
-    fhir_resource: dict, response: Response, db: Session = Depends(get_db)
+async def create_patient(
+    fhir_resource: dict,
+    idempotency_key: Optional[str] = Header(None),
+    db: AsyncSession = Depends(get_db),
 ):
     """Create a new patient from FHIR resource"""
     try:
@@ -99,90 +96,98 @@ def create_patient(
 
         patient = Patient()
         patient.from_fhir(fhir_resource)
-        print("→ About to add patient")
-        safe_add(db, patient)
-        print("✓ Patient added")
-
-        print("→ About to commit")
-        safe_commit(db)
-        print("✓ Commit done")
-
-        print("→ About to refresh")
-        safe_refresh(db, patient)
-        print("✓ Refresh done")
+        patient = await save_and_refresh(db, patient, idempotency_key)
 
-        # Set Location header
-        response.headers["Location"] = f"/Patient/{patient.id}"
-        return patient.to_fhir()
+        schedule_refresh(patient_fhir_mv)
+        return fhir_response(
+            patient.to_fhir(),
+            status_code=201,
+            headers={"Location": f"/Patient/{patient.id}"},
+        )
     except ValueError as e:
         raise HTTPException(status_code=400, detail=str(e))
     except Exception as e:
         raise HTTPException(status_code=500, detail=str(e))
 
 
-@router.get("/", response_model=dict)
-def search_patients(
+@router.get("/")
+async def search_patients(
     email: Optional[str] = Query(None),
     family: Optional[str] = Query(None),
     given: Optional[str] = Query(None),
     gender: Optional[str] = Query(None),
-    birth_date: Optional[str] = Query(None),
+    birth_date: Optional[date] = Query(None),
     _count: Optional[int] = Query(10, alias="count"),
     _offset: Optional[int] = Query(0),
-    db: Session = Depends(get_db),
+    db: AsyncSession = Depends(get_db),
 ):
     """Search for patients with FHIR search parameters"""
-    query = db.query(Patient)
+    view = patient_fhir_mv.c
+    # Entries are pre-built in the view, COUNT(*) OVER () adds the match total
+    # to the same round trip
+    query = select(view.entry, func.count().over())
 
     if email:
         # Search in telecom array for email
-        query = query.filter(
-            Patient.telecom.contains([{"system": "email", "value": email}])
+        query = query.where(
+            view.telecom.contains([{"system": "email", "value": email}])
         )
     if family:
-        query = query.filter(Patient.name.contains({"family": family}))
+        query = query.where(view.name.contains([{"family": family}]))
     if given:
-        query = query.filter(Patient.name.contains({"given": [given]}))
+        query = query.where(view.name.contains([{"given": [given]}]))
     if gender:
-        query = query.filter(Patient.gender == gender)
+        query = query.where(view.gender == gender)
     if birth_date:
-        query = query.filter(Patient.birth_date == birth_date)
-
-    total = query.count()
-    patients = query.offset(_offset).limit(_count).all()
-
-    return {
+        query = query.where(view.birth_date == birth_date)
+
+    rows = (await safe_execute(db, query.offset(_offset).limit(_count))).all()
+    if rows:
+        total = rows[0][1]
+    elif _offset:
+        # An empty page past the end still needs the real total
+        count_query = select(func.count()).select_from(query.subquery())
+        total = (await safe_execute(db, count_query)).scalar()
+    else:
+        total = 0
+
+    bundle = {
         "resourceType": "Bundle",
         "type": "searchset",
         "total": total,
-        "entry": [
-            {"resource": patient.to_fhir(), "fullUrl": f"/Patient/{patient.id}"}
-            for patient in patients
-        ],
+        "entry": [entry for entry, _ in rows],
     }
+    return fhir_response(bundle)
 
 
 @router.get("/{patient_id}")
-def get_patient(patient_id: str, db: Session = Depends(get_db)):
+async def get_patient(
+    patient_id: uuid.UUID, request: Request, db: AsyncSession = Depends(get_db)
+):
     """Get a specific patient by ID"""
-    patient = db.query(Patient).filter(Patient.id == patient_id).first()
-    if patient is None:
+    response = await cached_read(request, db, Patient, patient_id)
+    if response is None:
         raise HTTPException(status_code=404, detail="Patient not found")
-    return patient.to_fhir()
+    return response
 
 
 @router.put("/{patient_id}")
-def update_patient(patient_id: str, fhir_resource: dict, db: Session = Depends(get_db)):
+async def update_patient(
+    patient_id: uuid.UUID,
+    fhir_resource: dict,
+    db: AsyncSession = Depends(get_db),
+):
     """Update a patient from FHIR resource"""
-    patient = db.query(Patient).filter(Patient.id == patient_id).first()
+    patient = await db.get(Patient, patient_id)
     if patient is None:
         raise HTTPException(status_code=404, detail="Patient not found")
 
     try:
         patient.from_fhir(fhir_resource)
-        safe_db_operation(db, operation="commit")
-        safe_db_operation(db, patient, "refresh")
-        return patient.to_fhir()
+        await safe_commit(db)
+        await safe_refresh(db, patient)
+        schedule_refresh(patient_fhir_mv)
+        return fhir_response(patient.to_fhir())
     except ValueError as e:
         raise HTTPException(status_code=400, detail=str(e))
     except Exception as e:
@@ -190,13 +195,18 @@ def update_patient(patient_id: str, fhir_resource: dict, db: Session = Depends(g
 
 
 @router.delete("/{patient_id}", status_code=204)
-def delete_patient(patient_id: str, db: Session = Depends(get_db)):
+async def delete_patient(
+    patient_id: uuid.UUID,
+    db: AsyncSession = Depends(get_db),
+):
     """Delete a patient and all related resources"""
-    patient = db.query(Patient).filter(Patient.id == patient_id).first()
+    patient = await db.get(Patient, patient_id)
     if patient is None:
         # Return 204 even if not found, as per FHIR spec
         return Response(status_code=204)
 
-    safe_db_operation(db, patient, "delete")
-    safe_db_operation(db, operation="commit")
+    await safe_delete(db, patient)
+    await safe_commit(db)
+    # Observations go with the patient (cascade)
+    schedule_refresh(patient_fhir_mv, observation_fhir_mv)
     return Response(status_code=204)
@@ -0,0 +1,92 @@
+from collections import OrderedDict
+from datetime import datetime, timezone
+from typing import Any, Hashable, Optional
+from fastapi import Request, Response
+from sqlalchemy import select
+from sqlalchemy.ext.asyncio import AsyncSession
+from app.utils.db import safe_execute
+from app.utils.response import FHIR_JSON, fhir_response
+
+
+class LRUCache:
+    """Least-recently-used cache of serialized response bodies"""
+
+    def __init__(self, maxsize: int = 4096):
+        self.maxsize = maxsize
+        self._bodies = OrderedDict()
+
+    def get(self, key: Hashable) -> Optional[bytes]:
+        body = self._bodies.get(key)
+        if body is not None:
+            self._bodies.move_to_end(key)
+        return body
+
+    def put(self, key: Hashable, body: bytes) -> None:
+        self._bodies[key] = body
+        self._bodies.move_to_end(key)
+        if len(self._bodies) > self.maxsize:
+            self._bodies.popitem(last=False)
+
+
+# Serialized resources keyed by (resource type, id, last updated), so an
+# update never serves a stale body and old versions simply age out
+resource_cache = LRUCache(maxsize=4096)
+
+
+def version_etag(updated: datetime) -> str:
+    """Weak ETag for a resource version, stored as naive UTC"""
+    return f'W/"{updated.replace(tzinfo=timezone.utc).timestamp()}"'
+
+
+def etag_matches(request: Request, etag: str) -> bool:
+    """Check whether the client's If-None-Match already covers this ETag"""
+    header = request.headers.get("if-none-match")
+    if not header:
+        return False
+    tags = [tag.strip() for tag in header.split(",")]
+    return "*" in tags or etag in tags
+
+
+async def cached_read(
+    request: Request, db: AsyncSession, model: Any, resource_id: Any
+) -> Optional[Response]:
+    """
+    Read a resource, answering 304 when the client already has the current
+    version and serving the body from resource_cache when it is unchanged.
+
+    Args:
+        request: The incoming request, for If-None-Match
+        db: The database session
+        model: The resource model class
+        resource_id: The resource ID
+
+    Returns:
+        The response, or None if the resource does not exist
+    """
+    # Only the version is fetched up front, the row is loaded on a cache miss
+    version_query = select(model.updated).where(model.id == resource_id)
+    row = (await safe_execute(db, version_query)).first()
+    if row is None:
+        return None
+
+    # Rows written outside the ORM can lack a version, those are never cached
+    if row.updated is not None:
+        etag = version_etag(row.updated)
+        if etag_matches(request, etag):
+            return Response(status_code=304, headers={"ETag": etag})
+        body = resource_cache.get((model.__name__, resource_id, row.updated))
+        if body is not None:
+            return Response(content=body, media_type=FHIR_JSON, headers={"ETag": etag})
+
+    resource = await db.get(model, resource_id)
+    if resource is None:
+        return None
+    body = fhir_response(resource.to_fhir()).body
+    # Key on the loaded row's version in case it changed in between
+    updated = resource.updated
+    if updated is None:
+        return Response(content=body, media_type=FHIR_JSON)
+    resource_cache.put((model.__name__, resource_id, updated), body)
+    return Response(
+        content=body, media_type=FHIR_JSON, headers={"ETag": version_etag(updated)}
+    )
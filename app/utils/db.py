@@ -1,66 +1,375 @@
-from tenacity import retry, stop_after_attempt, wait_fixed, retry_if_exception_type
-from sqlalchemy.exc import OperationalError
-from typing import Any
-from sqlalchemy.orm import Session
+from tenacity import (
+    AsyncRetrying,
+    RetryCallState,
+    retry_if_exception,
+    stop_after_attempt,
+    wait_random_exponential,
+)
+from sqlalchemy import Executable, Result, inspect, select
+from sqlalchemy.dialects.postgresql import insert as pg_insert
+from sqlalchemy.exc import (
+    DBAPIError,
+    DisconnectionError,
+    InterfaceError,
+)
+import logging
+import warnings
+from contextlib import asynccontextmanager
+from typing import (
+    Any,
+    AsyncIterator,
+    Awaitable,
+    Callable,
+    Iterable,
+    Literal,
+    Mapping,
+    Optional,
+    Sequence,
+    Union,
+)
+from sqlalchemy.ext.asyncio import AsyncSession
+from sqlalchemy.orm import DeclarativeBase
+
+__all__ = [
+    "with_db_retry",
+    "safe_add",
+    "safe_execute",
+    "safe_commit",
+    "safe_flush",
+    "safe_refresh",
+    "safe_delete",
+    "save_and_refresh",
+    "add_in_savepoint",
+    "safe_bulk_add",
+    "batch_commit",
+    "safe_db_operation",
+]
+
+logger = logging.getLogger(__name__)
+
+# Postgres SQLSTATEs worth retrying besides class 08 (connection exception):
+# admin_shutdown, crash_shutdown and cannot_connect_now, seen across restarts
+_TRANSIENT_PGCODES = {"57P01", "57P02", "57P03"}
+
+
+def _is_transient(exc: BaseException) -> bool:
+    """Whether an error comes from a lost or refused connection"""
+    if isinstance(exc, (DisconnectionError, InterfaceError)):
+        return True
+    if not isinstance(exc, DBAPIError):
+        return False
+    if exc.connection_invalidated:
+        return True
+    # asyncpg errors without a more specific mapping arrive as plain DBAPIError,
+    # so go by the SQLSTATE rather than the exception class
+    pgcode = getattr(exc.orig, "pgcode", None) or ""
+    return pgcode.startswith("08") or pgcode in _TRANSIENT_PGCODES
+
+
+def _log_retry(retry_state: RetryCallState) -> None:
+    """Log each retry, to tune the attempts and backoff from real failures"""
+    exc = retry_state.outcome.exception()
+    logger.warning(
+        "Retrying %s after %s (pgcode=%s): attempt %d failed, sleeping %.2fs",
+        getattr(retry_state.fn, "__qualname__", retry_state.fn),
+        type(exc).__name__,
+        getattr(getattr(exc, "orig", None), "pgcode", None),
+        retry_state.attempt_number,
+        retry_state.next_action.sleep,
+    )
+
+
+# Retry policy, built once. The strategies keep no per-call state, so they are
+# shared by every controller using them.
+_STOP = stop_after_attempt(5)
+_WAIT = wait_random_exponential(multiplier=0.1, max=2.0)
+_RETRY_COND = retry_if_exception(_is_transient)
+
+# Shared by every retried operation. Each call runs on its own copy, so
+# concurrent calls don't share attempt state.
+_RETRYER = AsyncRetrying(
+    stop=_STOP,
+    wait=_WAIT,
+    retry=_RETRY_COND,
+    before_sleep=_log_retry,
+    reraise=True,
+)
 
 
 # Define retry decorator for database operations
 def with_db_retry(func):
     """
-    Decorator that adds retry logic to database operations.
-    Retries up to 3 times with a 2 second delay between attempts.
-    """
+    Decorator that adds retry logic to database operations, for transient
+    connection errors only. Makes up to 5 attempts, with full jitter: each
+    wait is random between 0 and a cap that doubles from 0.1s up to 2s, so
+    workers don't retry a recovering database in lock-step.
 
-    @retry(
-        stop=stop_after_attempt(3),
-        wait=wait_fixed(2),
-        retry=retry_if_exception_type(OperationalError),
-        reraise=True,
-    )
-    def wrapper(*args, **kwargs):
-        return func(*args, **kwargs)
+    Stale pooled connections are already replaced on checkout by the engine's
+    pool_pre_ping (app/db.py), so this only covers connections lost mid-query,
+    e.g. during a database restart or failover.
 
-    return wrapper
+    A lost connection takes the transaction, and everything flushed in it,
+    with it. So only whole units of work that own their session are retried
+    (safe_execute, save_and_refresh, safe_bulk_add, and only while the
+    session holds nothing else); single steps such as commit or flush are not.
+    """
+    return _RETRYER.wraps(func)
 
 
-@with_db_retry
-def safe_add(db: Session, obj: Any) -> None:
-    """Safely add an object to the database with retry logic"""
+async def safe_add(db: AsyncSession, obj: DeclarativeBase) -> None:
+    """Add an object to the session, written on the next flush or commit"""
     db.add(obj)
 
 
+def _session_is_clean(db: AsyncSession, objs: Iterable[DeclarativeBase] = ()) -> bool:
+    """Whether the session has no transaction and nothing staged besides objs"""
+    if db.in_transaction() or db.dirty or db.deleted:
+        return False
+    own = {id(obj) for obj in objs}
+    return all(id(obj) in own for obj in db.new)
+
+
+async def safe_execute(
+    db: AsyncSession, stmt: Executable, params: Optional[Mapping[str, Any]] = None
+) -> Result:
+    """Execute a statement, retried only if the session has no other work"""
+    if not _session_is_clean(db):
+        return await db.execute(stmt, params)
+    return await _retried_execute(db, stmt, params)
+
+
 @with_db_retry
-def safe_commit(db: Session) -> None:
-    """Safely commit changes to the database with retry logic"""
-    db.commit()
+async def _retried_execute(
+    db: AsyncSession, stmt: Executable, params: Optional[Mapping[str, Any]]
+) -> Result:
+    try:
+        return await db.execute(stmt, params)
+    except Exception as exc:
+        if _is_transient(exc):
+            await db.rollback()
+        raise
+
+
+async def safe_commit(db: AsyncSession) -> None:
+    """Commit the session's transaction"""
+    await db.commit()
+
+
+async def safe_flush(db: AsyncSession) -> None:
+    """Write pending changes without committing, e.g. to get generated ids"""
+    await db.flush()
+
+
+async def safe_refresh(db: AsyncSession, obj: DeclarativeBase) -> None:
+    """Refresh an object from the database"""
+    await db.refresh(obj)
+
+
+async def safe_delete(db: AsyncSession, obj: DeclarativeBase) -> None:
+    """Mark an object for deletion on the next flush or commit"""
+    await db.delete(obj)
+
+
+async def save_and_refresh(
+    db: AsyncSession, obj: DeclarativeBase, idempotency_key: Optional[str] = None
+) -> DeclarativeBase:
+    """
+    Add and commit an object as one unit of work.
+
+    The INSERT's RETURNING fills in server defaults and sessions don't expire
+    on commit, so the object is only refreshed if the session expired it.
+
+    Args:
+        db: The database session
+        obj: The object to insert
+        idempotency_key: Optional client-supplied key. The row is then inserted
+            with ON CONFLICT DO NOTHING, so a retry, or a repeated request,
+            whose earlier commit went through returns the stored row instead of
+            writing a duplicate.
+
+    Returns:
+        The stored object: obj itself, or the existing row for a replayed key
+    """
+    if not _session_is_clean(db, [obj]):
+        return await _save(db, obj, idempotency_key)
+    return await _retried_save(db, obj, idempotency_key)
 
 
 @with_db_retry
-def safe_refresh(db: Session, obj: Any) -> None:
-    """Safely refresh an object from the database with retry logic"""
-    db.refresh(obj)
+async def _retried_save(
+    db: AsyncSession, obj: DeclarativeBase, idempotency_key: Optional[str]
+) -> DeclarativeBase:
+    try:
+        return await _save(db, obj, idempotency_key)
+    except Exception:
+        # Nothing but obj is lost, leave the session usable for the next attempt
+        await db.rollback()
+        raise
+
+
+async def _save(
+    db: AsyncSession, obj: DeclarativeBase, idempotency_key: Optional[str]
+) -> DeclarativeBase:
+    if idempotency_key is None:
+        db.add(obj)
+        saved = obj
+    else:
+        saved = await _insert_once(db, obj, idempotency_key)
+    await db.commit()
+    if inspect(saved).expired_attributes:
+        await db.refresh(saved)
+    return saved
+
+
+async def _insert_once(
+    db: AsyncSession, obj: DeclarativeBase, idempotency_key: str
+) -> DeclarativeBase:
+    model = type(obj)
+    obj.idempotency_key = idempotency_key
+    # Only the attributes that were set, so column defaults still apply
+    state = inspect(obj)
+    values = {
+        attr.key: getattr(obj, attr.key)
+        for attr in state.mapper.column_attrs
+        if attr.key in state.dict
+    }
+    stmt = (
+        pg_insert(model)
+        .values(values)
+        .on_conflict_do_nothing(index_elements=[model.idempotency_key])
+        .returning(model)
+    )
+    saved = (await db.scalars(stmt)).one_or_none()
+    if saved is None:
+        saved = await db.scalar(
+            select(model).where(model.idempotency_key == idempotency_key)
+        )
+    return saved
+
+
+async def add_in_savepoint(db: AsyncSession, obj: DeclarativeBase) -> None:
+    """
+    Add and flush an object inside a SAVEPOINT, so a failed INSERT undoes only
+    this object and leaves the rest of the transaction usable.
+    """
+    async with db.begin_nested():
+        db.add(obj)
+
+
+async def safe_bulk_add(
+    db: AsyncSession, objs: Iterable[DeclarativeBase], chunk_size: int = 500
+) -> None:
+    """
+    Insert many objects in one transaction, flushing every chunk_size objects
+    and committing once at the end instead of once per object.
+
+    Args:
+        db: The database session
+        objs: The objects to insert
+        chunk_size: How many objects to flush at a time
+    """
+    # Materialized so a retry can replay it
+    objs = list(objs)
+    if not _session_is_clean(db, objs):
+        await _bulk_add(db, objs, chunk_size)
+    else:
+        await _retried_bulk_add(db, objs, chunk_size)
 
 
 @with_db_retry
-def safe_delete(db: Session, obj: Any) -> None:
-    """Safely delete an object from the database with retry logic"""
-    db.delete(obj)
+async def _retried_bulk_add(
+    db: AsyncSession, objs: Sequence[DeclarativeBase], chunk_size: int
+) -> None:
+    try:
+        await _bulk_add(db, objs, chunk_size)
+    except Exception:
+        await db.rollback()
+        raise
+
+
+async def _bulk_add(
+    db: AsyncSession, objs: Sequence[DeclarativeBase], chunk_size: int
+) -> None:
+    for start in range(0, len(objs), chunk_size):
+        db.add_all(objs[start : start + chunk_size])
+        await db.flush()
+    await db.commit()
 
 
-def safe_db_operation(db: Session, obj: Any = None, operation: str = None) -> None:
+@asynccontextmanager
+async def batch_commit(
+    db: AsyncSession, every: int = 100
+) -> AsyncIterator[Callable[[], Awaitable[None]]]:
     """
-    Perform a database operation safely with retries.
+    Commit a loop of writes every few iterations rather than on each one.
+
+    Yields a tick() coroutine to await once per iteration: it flushes, and
+    commits every `every` ticks. The rest is committed on exit. If the block
+    raises, only the writes since the last commit are rolled back.
+
+    Usage:
+        async with batch_commit(db) as tick:
+            for resource in resources:
+                db.add(resource)
+                await tick()
+    """
+    count = 0
+
+    async def tick() -> None:
+        nonlocal count
+        count += 1
+        await db.flush()
+        if count % every == 0:
+            await safe_commit(db)
+
+    try:
+        yield tick
+    except BaseException:
+        await db.rollback()
+        raise
+    await safe_commit(db)
+
+
+Operation = Literal["add", "commit", "flush", "refresh", "delete", "save", "bulk_add"]
+
+# Operation name -> handler, each called as handler(db, obj)
+_OPERATIONS = {
+    "add": safe_add,
+    "commit": lambda db, obj: safe_commit(db),
+    "flush": lambda db, obj: safe_flush(db),
+    "refresh": safe_refresh,
+    "delete": safe_delete,
+    "save": save_and_refresh,
+    "bulk_add": safe_bulk_add,
+}
+
+
+async def safe_db_operation(
+    db: AsyncSession,
+    obj: Union[DeclarativeBase, Iterable[DeclarativeBase], None] = None,
+    operation: Optional[Operation] = None,
+) -> None:
+    """
+    Perform a database operation.
+
+    Deprecated: call the safe_* function for the operation directly.
 
     Args:
         db: The database session
-        obj: The object to operate on (for add, refresh, delete operations)
-        operation: The operation to perform ('add', 'commit', 'refresh', 'delete')
+        obj: The object to operate on (for add, refresh, delete operations), or
+            the objects to insert for bulk_add
+        operation: The operation to perform ('add', 'commit', 'flush', 'refresh',
+            'delete', 'save', 'bulk_add')
+
+    Raises:
+        ValueError: If the operation is unknown
     """
-    if operation == "add" and obj is not None:
-        safe_add(db, obj)
-    elif operation == "commit":
-        safe_commit(db)
-    elif operation == "refresh" and obj is not None:
-        safe_refresh(db, obj)
-    elif operation == "delete" and obj is not None:
-        safe_delete(db, obj)
+    warnings.warn(
+        "safe_db_operation() is deprecated, call the safe_* functions directly",
+        DeprecationWarning,
+        stacklevel=2,
+    )
+    handler = _OPERATIONS.get(operation)
+    if handler is None:
+        raise ValueError(f"Unknown database operation: {operation}")
+    await handler(db, obj)
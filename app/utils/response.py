@@ -0,0 +1,24 @@
+import orjson
+from fastapi import Response
+from typing import Any, Mapping, Optional
+
+FHIR_JSON = "application/fhir+json"
+
+
+def fhir_response(
+    content: Any, status_code: int = 200, headers: Optional[Mapping[str, str]] = None
+) -> Response:
+    """
+    Serialize a FHIR resource straight to a response, skipping jsonable_encoder.
+
+    Args:
+        content: The FHIR resource (or Bundle) as a dict
+        status_code: HTTP status code of the response
+        headers: Extra headers to send, e.g. Location on create
+    """
+    return Response(
+        content=orjson.dumps(content, default=str),
+        status_code=status_code,
+        headers=headers,
+        media_type=FHIR_JSON,
+    )
@@ -0,0 +1,148 @@
+import asyncio
+import logging
+import os
+from sqlalchemy import Column, Index, MetaData, Table, func, select, text
+from sqlalchemy.dialects import postgresql
+from app.db import engine
+from app.models.base import json_object
+from app.models.observation import Observation
+from app.models.patient import Patient
+
+logger = logging.getLogger(__name__)
+
+# Kept apart from Base.metadata so create_all() never makes these plain tables
+view_metadata = MetaData()
+
+
+def _fhir_view(name, model, *search_columns):
+    """
+    Declare a materialized view holding the search columns of a model plus its
+    pre-built Bundle entry, so searches read JSON instead of rebuilding it.
+    """
+    query = select(
+        model.id,
+        *search_columns,
+        json_object(
+            {
+                "fullUrl": func.concat(f"/{model.__name__}/", model.id),
+                "resource": model.fhir_json(),
+            }
+        ).label("entry"),
+    )
+    view = Table(
+        name,
+        view_metadata,
+        *(Column(c.key, c.type) for c in query.selected_columns),
+    )
+    view.info["query"] = query
+    # REFRESH ... CONCURRENTLY needs a unique index
+    Index(f"ux_{name}_id", view.c.id, unique=True)
+    return view
+
+
+def _gin(view, column):
+    Index(
+        f"ix_{view.name}_{column}",
+        view.c[column],
+        postgresql_using="gin",
+        postgresql_ops={column: "jsonb_path_ops"},
+    )
+
+
+patient_fhir_mv = _fhir_view(
+    "patient_fhir_mv",
+    Patient,
+    Patient.gender,
+    Patient.birth_date,
+    Patient.name,
+    Patient.telecom,
+)
+Index("ix_patient_fhir_mv_gender", patient_fhir_mv.c.gender)
+Index("ix_patient_fhir_mv_birth_date", patient_fhir_mv.c.birth_date)
+_gin(patient_fhir_mv, "name")
+_gin(patient_fhir_mv, "telecom")
+
+observation_fhir_mv = _fhir_view(
+    "observation_fhir_mv",
+    Observation,
+    Observation.subject_reference,
+    Observation.effective_datetime,
+    Observation.category,
+    Observation.code,
+)
+Index(
+    "ix_observation_fhir_mv_subject_effective",
+    observation_fhir_mv.c.subject_reference,
+    observation_fhir_mv.c.effective_datetime,
+)
+Index("ix_observation_fhir_mv_effective", observation_fhir_mv.c.effective_datetime)
+_gin(observation_fhir_mv, "category")
+_gin(observation_fhir_mv, "code")
+
+
+def create_views(conn):
+    """
+    Create the materialized views and their indexes if they don't exist.
+    Takes a sync connection, e.g. through AsyncConnection.run_sync().
+    """
+    for view in view_metadata.sorted_tables:
+        query = view.info["query"].compile(
+            dialect=postgresql.dialect(), compile_kwargs={"literal_binds": True}
+        )
+        conn.execute(
+            text(f"CREATE MATERIALIZED VIEW IF NOT EXISTS {view.name} AS {query}")
+        )
+        for index in view.indexes:
+            index.create(conn, checkfirst=True)
+
+
+# Seconds between a write and the refresh it schedules, so a burst of writes
+# shares one refresh
+REFRESH_DELAY = float(os.getenv("VIEW_REFRESH_DELAY", "1"))
+
+# Views with a refresh scheduled but not started yet. Only touched from the
+# event loop, so no locking is needed.
+_pending_views = set()
+# One lock per view, so at most one refresh of it runs at a time
+_refresh_locks = {}
+# asyncio only keeps weak references to tasks, these keep them alive
+_refresh_tasks = set()
+
+
+def schedule_refresh(*views: Table) -> None:
+    """
+    Refresh views shortly after a write, without holding up the response.
+
+    Each view has at most one refresh running and one pending. Writes landing
+    while a refresh is pending share it, so under steady write load a view is
+    refreshed back to back rather than once per write. Searches can lag writes
+    until the refresh finishes.
+    """
+    for view in views:
+        if view.name in _pending_views:
+            continue
+        _pending_views.add(view.name)
+        task = asyncio.create_task(_refresh_later(view))
+        _refresh_tasks.add(task)
+        task.add_done_callback(_refresh_tasks.discard)
+
+
+async def _refresh_later(view: Table) -> None:
+    await asyncio.sleep(REFRESH_DELAY)
+    lock = _refresh_locks.setdefault(view.name, asyncio.Lock())
+    async with lock:
+        # Writes from here on need another refresh to be seen
+        _pending_views.discard(view.name)
+        try:
+            async with engine.begin() as conn:
+                await conn.execute(
+                    text(f"REFRESH MATERIALIZED VIEW CONCURRENTLY {view.name}")
+                )
+        except Exception:
+            logger.exception("Refreshing %s failed", view.name)
+
+
+async def wait_for_refreshes() -> None:
+    """Wait for scheduled refreshes to finish, e.g. before shutting down"""
+    while _refresh_tasks:
+        await asyncio.gather(*_refresh_tasks)
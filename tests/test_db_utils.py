@@ -0,0 +1,138 @@
+import asyncio
+import asyncpg
+import pytest
+from sqlalchemy.dialects.postgresql.asyncpg import AsyncAdapt_asyncpg_dbapi
+from sqlalchemy.exc import DBAPIError
+from app.models.patient import Patient
+from app.utils.db import _is_transient, safe_bulk_add, safe_execute, save_and_refresh
+
+dbapi = AsyncAdapt_asyncpg_dbapi(asyncpg)
+
+
+class FlakySession:
+    """Stands in for an AsyncSession whose connection drops on the first call"""
+
+    def __init__(self, in_transaction=False, new=()):
+        self._in_transaction = in_transaction
+        self.new = set(new)
+        self.dirty = set()
+        self.deleted = set()
+        self.calls = 0
+        self.rollbacks = 0
+
+    def in_transaction(self):
+        return self._in_transaction
+
+    def _call(self):
+        self.calls += 1
+        if self.calls == 1:
+            raise wrap(asyncpg.exceptions.ConnectionDoesNotExistError("lost"))
+
+    async def execute(self, stmt, params=None):
+        self._call()
+        return "result"
+
+    def add(self, obj):
+        self.new.add(obj)
+
+    def add_all(self, objs):
+        self.new.update(objs)
+
+    async def flush(self):
+        pass
+
+    async def commit(self):
+        self._call()
+        self.new.clear()
+
+    async def rollback(self):
+        self.rollbacks += 1
+        self.new.clear()
+        self._in_transaction = False
+
+
+def wrap(error):
+    """Wrap an asyncpg error the way SQLAlchemy's asyncpg dialect does"""
+    for cls in type(error).__mro__:
+        if cls in dbapi._asyncpg_error_translate:
+            translated = dbapi._asyncpg_error_translate[cls](str(error))
+            translated.pgcode = translated.sqlstate = error.sqlstate
+            return DBAPIError.instance("SELECT 1", {}, translated, dbapi.Error)
+    raise AssertionError(f"No translation for {type(error).__name__}")
+
+
+@pytest.mark.parametrize(
+    "error",
+    [
+        asyncpg.exceptions.ConnectionDoesNotExistError,  # 08003
+        asyncpg.exceptions.ConnectionFailureError,  # 08006
+        asyncpg.exceptions.AdminShutdownError,  # 57P01
+        asyncpg.exceptions.CrashShutdownError,  # 57P02
+        asyncpg.exceptions.CannotConnectNowError,  # 57P03
+    ],
+)
+def test_connection_errors_are_transient(error):
+    assert _is_transient(wrap(error("connection lost")))
+
+
+@pytest.mark.parametrize(
+    "error",
+    [
+        asyncpg.exceptions.QueryCanceledError,  # 57014, statement timeout
+        asyncpg.exceptions.InvalidPasswordError,  # 28P01
+        asyncpg.exceptions.UniqueViolationError,  # 23505
+    ],
+)
+def test_other_errors_are_not_transient(error):
+    assert not _is_transient(wrap(error("failed")))
+
+
+def test_invalidated_connection_is_transient():
+    error = DBAPIError("SELECT 1", {}, dbapi.Error("gone"), connection_invalidated=True)
+    assert _is_transient(error)
+
+
+def test_non_database_errors_are_not_transient():
+    assert not _is_transient(ValueError("bad input"))
+
+
+def test_execute_retries_on_a_clean_session():
+    db = FlakySession()
+    assert asyncio.run(safe_execute(db, "SELECT 1")) == "result"
+    assert (db.calls, db.rollbacks) == (2, 1)
+
+
+@pytest.mark.parametrize(
+    "db", [FlakySession(in_transaction=True), FlakySession(new=[object()])]
+)
+def test_execute_keeps_other_work_instead_of_retrying(db):
+    with pytest.raises(DBAPIError):
+        asyncio.run(safe_execute(db, "SELECT 1"))
+    assert (db.calls, db.rollbacks) == (1, 0)
+
+
+def test_save_retries_when_the_session_holds_only_obj():
+    db, patient = FlakySession(), Patient()
+    assert asyncio.run(save_and_refresh(db, patient)) is patient
+    assert (db.calls, db.rollbacks) == (2, 1)
+
+
+def test_save_keeps_other_staged_work_instead_of_retrying():
+    db = FlakySession(new=[Patient()])
+    with pytest.raises(DBAPIError):
+        asyncio.run(save_and_refresh(db, Patient()))
+    assert (db.calls, db.rollbacks) == (1, 0)
+    assert len(db.new) == 2
+
+
+def test_bulk_add_retries_when_the_session_holds_only_objs():
+    db = FlakySession()
+    asyncio.run(safe_bulk_add(db, [Patient(), Patient()]))
+    assert (db.calls, db.rollbacks) == (2, 1)
+
+
+def test_bulk_add_inside_a_transaction_is_not_retried():
+    db = FlakySession(in_transaction=True)
+    with pytest.raises(DBAPIError):
+        asyncio.run(safe_bulk_add(db, [Patient(), Patient()]))
+    assert (db.calls, db.rollbacks) == (1, 0)